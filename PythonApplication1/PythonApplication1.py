@@ -1,23 +1,47 @@
 ﻿import os
 import re
+import html
 import json
+import atexit
+import hashlib
 import time
 import asyncio
 import logging
+import sqlite3
 import tempfile
+import threading
+from collections import deque
+from http.cookiejar import CookieJar, DefaultCookiePolicy
 
-from flask import Flask, render_template_string, request, session as flask_session
+import httpx
+from a2wsgi import WSGIMiddleware
+from flask import Flask, request, url_for, session as flask_session
+from streaming_form_data import ParseFailedException, StreamingFormDataParser
+from streaming_form_data.targets import BaseTarget, ValueTarget
+from tenacity import (
+    AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+)
 import pyimgbox
 
+try:
+    import uvloop  # not available on Windows
+except ImportError:
+    uvloop = None
+
 # ─── CONFIG ───────────────────────────────────────────────────────────────────
 BASE_DIR       = os.getcwd()
-TMP_DIR        = os.path.join(BASE_DIR, "uploads_tmp")
-GALLERIES_JSON = os.path.join(BASE_DIR, "galleries.json")
+SECRET_FILE    = os.path.join(BASE_DIR, ".secret")
+GALLERIES_DB   = os.path.join(BASE_DIR, "galleries.db")
+GALLERIES_JSON = os.path.join(BASE_DIR, "galleries.json")  # legacy store, imported once
+CONCURRENCY    = max(1, int(os.environ.get("IMGBOX_CONCURRENCY", "6")))
+MAX_ATTEMPTS   = 5
+RETRY_STATUSES = {429, 502, 503, 504}
+READ_CHUNK     = 64 * 1024
+MAX_UPLOAD_MB  = int(os.environ.get("IMGBOX_MAX_UPLOAD_MB", "1024"))
+THREADS        = max(1, int(os.environ.get("IMGBOX_THREADS", "16")))
+SPOOL_MAX_SIZE = 500 * 1024  # same in-memory threshold Werkzeug uses
 
-os.makedirs(TMP_DIR, exist_ok=True)
-if not os.path.exists(GALLERIES_JSON):
-    with open(GALLERIES_JSON, "w") as f:
-        json.dump({}, f)
+_EDIT_URL_RE = re.compile(r"/upload/edit/([^/]+)/([^/]+)$")
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(levelname)s %(message)s")
@@ -31,12 +55,11 @@ INDEX_HTML = """
   <meta charset="utf-8">
   <meta name="viewport" content="width=device-width, initial-scale=1">
   <title>Imgbox Uploader</title>
-  <link
-    href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css"
-    rel="stylesheet">
-  <link
-    href="https://cdn.datatables.net/1.13.4/css/dataTables.bootstrap5.min.css"
-    rel="stylesheet">
+  {% for origin in cdn_origins() %}
+  <link rel="preconnect" href="{{ origin }}">
+  {% endfor %}
+  <link href="{{ asset('bootstrap.min.css') }}" rel="stylesheet">
+  <link href="{{ asset('dataTables.bootstrap5.min.css') }}" rel="stylesheet">
 </head>
 <body class="bg-light">
 <div class="container py-5">
@@ -100,16 +123,10 @@ INDEX_HTML = """
   {% endif %}
 </div>
 
-<script src="https://code.jquery.com/jquery-3.6.1.min.js"></script>
-<script
-  src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js">
-</script>
-<script
-  src="https://cdn.datatables.net/1.13.4/js/jquery.dataTables.min.js">
-</script>
-<script
-  src="https://cdn.datatables.net/1.13.4/js/dataTables.bootstrap5.min.js">
-</script>
+<script src="{{ asset('jquery-3.6.1.min.js') }}"></script>
+<script src="{{ asset('bootstrap.bundle.min.js') }}"></script>
+<script src="{{ asset('jquery.dataTables.min.js') }}"></script>
+<script src="{{ asset('dataTables.bootstrap5.min.js') }}"></script>
 <script>
   $(document).ready(() => {
     $('#tbl').DataTable({
@@ -123,106 +140,470 @@ INDEX_HTML = """
 </html>
 """
 
-# ─── JSON STORE HELPERS ────────────────────────────────────────────────────────
+# Third-party page assets. A copy saved under static/vendor/ with the same
+# file name is served locally (one origin, long-lived cache) instead of
+# the CDN; otherwise the page preconnects to the CDN origins it needs.
+VENDOR_ASSETS = {
+    "bootstrap.min.css":
+        "https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css",
+    "bootstrap.bundle.min.js":
+        "https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js",
+    "jquery-3.6.1.min.js":
+        "https://code.jquery.com/jquery-3.6.1.min.js",
+    "dataTables.bootstrap5.min.css":
+        "https://cdn.datatables.net/1.13.4/css/dataTables.bootstrap5.min.css",
+    "jquery.dataTables.min.js":
+        "https://cdn.datatables.net/1.13.4/js/jquery.dataTables.min.js",
+    "dataTables.bootstrap5.min.js":
+        "https://cdn.datatables.net/1.13.4/js/dataTables.bootstrap5.min.js",
+}
+
+# ─── GALLERY STORE ────────────────────────────────────────────────────────────
+def _open_store():
+    conn = sqlite3.connect(GALLERIES_DB, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS galleries("
+        "title TEXT PRIMARY KEY, gallery_url TEXT, edit_url TEXT)"
+    )
+    # Content hashes of files already in each gallery, for skipping re-uploads
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS uploads("
+        "title TEXT, sha256 TEXT, url TEXT, PRIMARY KEY (title, sha256))"
+    )
+    # Carry over history from the old galleries.json on first run
+    empty = conn.execute("SELECT 1 FROM galleries LIMIT 1").fetchone() is None
+    if empty and os.path.exists(GALLERIES_JSON):
+        with open(GALLERIES_JSON, "rb") as f:
+            try:
+                legacy = json.load(f)
+            except json.JSONDecodeError:
+                legacy = {}
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO galleries VALUES (?, ?, ?)",
+                [(t, i.get("gallery_url"), i.get("edit_url")) for t, i in legacy.items()]
+            )
+        log.info(f"Imported {len(legacy)} galleries from {GALLERIES_JSON}")
+    return conn
+
+_db = _open_store()
+
+# The connection is shared between request threads, so all access to it
+# goes through _store_lock. Gallery rows are kept as a dict and re-read
+# only when another connection commits.
+_store_lock  = threading.Lock()
+_links_cache = {"version": None, "data": {}}
+
+def _load_saved_store_locked():
+    version = _db.execute("PRAGMA data_version").fetchone()[0]
+    if version != _links_cache["version"]:
+        rows = _db.execute(
+            "SELECT title, gallery_url, edit_url FROM galleries ORDER BY rowid"
+        )
+        _links_cache["data"] = {
+            t: {"gallery_url": g, "edit_url": e} for t, g, e in rows
+        }
+        _links_cache["version"] = version
+    return _links_cache["data"]
+
 def load_saved_links():
-    with open(GALLERIES_JSON, "r") as f:
-        try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            return {}
+    with _store_lock:
+        return _load_saved_store_locked()
 
 def save_gallery_link(title, gallery_url, edit_url):
-    data = load_saved_links()
-    data[title] = {"gallery_url": gallery_url, "edit_url": edit_url}
-    with open(GALLERIES_JSON, "w") as f:
-        json.dump(data, f, indent=2)
+    with _store_lock:
+        with _db:
+            # Files recorded for the title's previous gallery are not in
+            # the new one, so they must not be skipped next time
+            _db.execute(
+                "DELETE FROM uploads WHERE title = ? AND EXISTS (SELECT 1 FROM "
+                "galleries WHERE title = ? AND gallery_url IS NOT ?)",
+                (title, title, gallery_url)
+            )
+            _db.execute(
+                "INSERT INTO galleries VALUES (?, ?, ?) ON CONFLICT(title) DO UPDATE "
+                "SET gallery_url = excluded.gallery_url, edit_url = excluded.edit_url",
+                (title, gallery_url, edit_url)
+            )
+        # Our own commits don't bump data_version, so patch the cache here.
+        # Copy so readers still iterating the old dict aren't disturbed.
+        data = dict(_load_saved_store_locked())
+        data[title] = {"gallery_url": gallery_url, "edit_url": edit_url}
+        _links_cache["data"] = data
+
+def lookup_uploads(title, digests):
+    """Returns {sha256: url} for the digests already uploaded to title."""
+    if not digests:
+        return {}
+    marks = ",".join("?" * len(digests))
+    with _store_lock:
+        rows = _db.execute(
+            f"SELECT sha256, url FROM uploads WHERE title = ? AND sha256 IN ({marks})",
+            (title, *digests)
+        ).fetchall()
+    return dict(rows)
+
+def save_uploads(title, pairs):
+    """Records (sha256, url) pairs as uploaded to title."""
+    if not pairs:
+        return
+    with _store_lock, _db:
+        _db.executemany(
+            "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)",
+            [(title, digest, url) for digest, url in pairs]
+        )
+
+# ─── SHARED HTTP CLIENT ───────────────────────────────────────────────────────
+# Flask runs every async view on a throwaway event loop, so pooled
+# connections could never be reused there. All imgbox traffic is instead
+# funnelled through one long-lived loop running in a background thread,
+# backed by uvloop where it is installed.
+_io_loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+threading.Thread(target=_io_loop.run_forever, name="imgbox-io", daemon=True).start()
+
+class _RetryableStatus(Exception):
+    def __init__(self, response):
+        super().__init__(f"HTTP {response.status_code}")
+        self.response = response
+
+
+class RetryTransport(httpx.AsyncBaseTransport):
+    """
+    Retries imgbox requests with jittered exponential backoff when the
+    server asks us to back off (429/502/503/504) or the connection could
+    not be made. Retrying has to happen here: pyimgbox folds every HTTP
+    error into a failed Submission, hiding the status code. Other 4xx
+    answers and failures after the request went out (which might
+    duplicate an upload) are passed straight back.
+    """
+    def __init__(self, transport):
+        self._transport = transport
+
+    async def handle_async_request(self, request):
+        retrying = AsyncRetrying(
+            stop=stop_after_attempt(MAX_ATTEMPTS),
+            wait=wait_exponential_jitter(initial=1, max=16),
+            retry=retry_if_exception_type(
+                (httpx.ConnectError, httpx.ConnectTimeout, _RetryableStatus)
+            ),
+            before_sleep=lambda state: log.warning(
+                f"Retry {state.attempt_number} for {request.url}: "
+                f"{state.outcome.exception()}"
+            ),
+            reraise=True,
+        )
+        try:
+            async for attempt in retrying:
+                with attempt:
+                    response = await self._transport.handle_async_request(request)
+                    if response.status_code in RETRY_STATUSES:
+                        await response.aread()
+                        raise _RetryableStatus(response)
+        except _RetryableStatus as e:
+            # Out of attempts: hand the last answer to pyimgbox as-is
+            return e.response
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+SHARED_CLIENT = httpx.AsyncClient(
+    transport=RetryTransport(httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+    )),
+    timeout=300,
+    # Shared between users, so never remember Set-Cookie responses
+    cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+)
+
+def run_on_io_loop(coro):
+    """Schedules coro on the I/O loop and returns an awaitable for it."""
+    return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, _io_loop))
+
+@atexit.register
+def _close_shared_client():
+    asyncio.run_coroutine_threadsafe(SHARED_CLIENT.aclose(), _io_loop).result(timeout=5)
+
+# ─── MULTIPART SPOOLING ───────────────────────────────────────────────────────
+class SpoolTarget(BaseTarget):
+    """
+    Receives every part of a repeated file field, spooling each one into
+    its own SpooledTemporaryFile in the order the browser sent them.
+    Small parts stay in memory; larger ones roll over to disk. A SHA-256
+    of each part is computed on the way through.
+    """
+    def __init__(self):
+        super().__init__()
+        self.infos = []
+        self.in_part = False
+
+    def on_start(self):
+        self.in_part = True
+        self.infos.append({
+            "stream": tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE),
+            "name": os.path.basename(self.multipart_filename or ""),
+            "hash": hashlib.sha256(),
+        })
+
+    def on_data_received(self, chunk):
+        info = self.infos[-1]
+        info["stream"].write(chunk)
+        info["hash"].update(chunk)
+
+    def on_finish(self):
+        self.in_part = False
+        info = self.infos[-1]
+        info["size"]   = info["stream"].tell()
+        info["sha256"] = info.pop("hash").hexdigest()
+        # An empty <input type=file> still sends a part with no filename
+        if not info["name"]:
+            self.infos.pop()["stream"].close()
+
+
+def parse_upload_form():
+    """
+    Parses the multipart body straight off the request stream, spooling
+    files as they arrive. Returns (title, session_cookie, infos).
+    """
+    parser = StreamingFormDataParser(headers=request.headers)
+    title_t, cookie_t, files_t = ValueTarget(), ValueTarget(), SpoolTarget()
+    parser.register("title", title_t)
+    parser.register("authCookie", cookie_t)
+    parser.register("files", files_t)
+
+    try:
+        while chunk := request.stream.read(READ_CHUNK):
+            parser.data_received(chunk)
+        # The parser doesn't complain when the body stops mid-part
+        if files_t.in_part:
+            raise ParseFailedException("Body ended inside a file part")
+    except Exception:
+        close_streams(files_t.infos)
+        raise
+
+    title  = title_t.value.decode("utf-8", "replace")
+    cookie = cookie_t.value.decode("utf-8", "replace")
+    return title, cookie, files_t.infos
+
+
+def close_streams(infos):
+    for info in infos:
+        info["stream"].close()
 
 # ─── FLASK APP ────────────────────────────────────────────────────────────────
+def _load_or_create_secret(path):
+    """
+    Returns the secret stored at path, creating it (mode 0600) on first
+    run so session cookies survive restarts. The key is written to a temp
+    file and published with os.link, so workers starting together never
+    read a half-written file and all end up with the same key.
+    """
+    try:
+        with open(path, "rb") as f:
+            existing = f.read()
+        if len(existing) >= 32:
+            return existing
+        log.warning(f"Regenerating truncated secret in {path}")
+    except FileNotFoundError:
+        existing = None
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".secret-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(os.urandom(32))
+            f.flush()
+            os.fsync(f.fileno())
+        if existing is None:
+            try:
+                os.link(tmp, path)
+            except FileExistsError:
+                pass  # another worker published first; use its key
+        else:
+            os.replace(tmp, path)
+    finally:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+    with open(path, "rb") as f:
+        return f.read()
+
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
+app.secret_key = os.environ.get("FLASK_SECRET") or _load_or_create_secret(SECRET_FILE)
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_MB * 1024 * 1024
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 31536000
+
+def _asset_version(name):
+    """Short content hash of a vendored file, or None if it is absent."""
+    try:
+        with open(os.path.join(app.static_folder, "vendor", name), "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()[:12]
+    except FileNotFoundError:
+        return None
+
+# Local asset URLs carry a content hash, so the year-long max-age above
+# can't keep serving a stale copy after a file is replaced
+_LOCAL_ASSETS = {
+    name: version for name in VENDOR_ASSETS
+    if (version := _asset_version(name))
+}
+_CDN_ORIGINS = sorted({
+    "/".join(url.split("/")[:3])
+    for name, url in VENDOR_ASSETS.items() if name not in _LOCAL_ASSETS
+})
+
+@app.template_global()
+def asset(name):
+    if name in _LOCAL_ASSETS:
+        return url_for("static", filename=f"vendor/{name}", v=_LOCAL_ASSETS[name])
+    return VENDOR_ASSETS[name]
+
+@app.template_global()
+def cdn_origins():
+    return _CDN_ORIGINS
+
+# Parse the page once through Flask's environment (autoescape, url_for)
+_INDEX_TPL = app.jinja_env.from_string(INDEX_HTML)
+
+def _render(saved_links, **overrides):
+    ctx = {
+        "session_cookie": flask_session.get("authCookie", ""),
+        "saved_links":    saved_links,
+        "error_message":  None,
+        "upload_results": None,
+        "upload_time":    None,
+    }
+    ctx.update(overrides)
+    return _INDEX_TPL.render(**ctx)
 
 @app.route("/", methods=["GET"])
 def index():
-    return render_template_string(
-        INDEX_HTML,
-        session_cookie=flask_session.get("authCookie", ""),
-        saved_links=load_saved_links()
-    )
+    return _render(load_saved_links())
 
 @app.route("/upload", methods=["POST"])
 async def upload():
-    session_cookie = request.form.get("authCookie", "").strip()
+    try:
+        # Reading the body is blocking I/O; request context is carried over
+        title, session_cookie, infos = await asyncio.to_thread(parse_upload_form)
+    except ParseFailedException as e:
+        log.warning(f"Rejected malformed upload: {e}")
+        return _render(
+            await asyncio.to_thread(load_saved_links),
+            error_message="Could not read the upload form; please try again."
+        ), 400
+    # Store reads and writes run in worker threads, off both this view's
+    # loop and the shared I/O loop. The links are read once per request.
+    saved_links = await asyncio.to_thread(load_saved_links)
+    session_cookie = session_cookie.strip()
     if not session_cookie:
-        return render_template_string(
-            INDEX_HTML,
+        await asyncio.to_thread(close_streams, infos)
+        return _render(
+            saved_links,
             error_message="Please provide your <code>_imgbox_session</code> cookie.",
-            session_cookie="",
-            saved_links=load_saved_links()
+            session_cookie=""
         )
 
-    title = request.form.get("title") or "Uploaded Gallery"
-    files = request.files.getlist("files")
-    if not files:
-        return render_template_string(
-            INDEX_HTML,
-            error_message="No files selected.",
-            session_cookie=session_cookie,
-            saved_links=load_saved_links()
+    title = title or "Uploaded Gallery"
+    if not infos:
+        return _render(
+            saved_links, error_message="No files selected.", session_cookie=session_cookie
         )
 
-    # Dump to zero-padded temp files in order
-    infos = []
-    for idx, f in enumerate(files, start=1):
-        orig = os.path.basename(f.filename)
-        ext  = os.path.splitext(orig)[1] or ""
-        data = f.read()
-        tmp  = tempfile.NamedTemporaryFile(
-            delete=False,
-            prefix=f"{idx:03d}_",
-            suffix=ext,
-            dir=TMP_DIR
+    saved  = saved_links.get(title, {})
+    cached = {}
+    if saved:
+        cached = await asyncio.to_thread(
+            lookup_uploads, title, [i["sha256"] for i in infos]
         )
-        tmp.write(data)
-        tmp.flush()
-        tmp.close()
-        infos.append({"path": tmp.name, "name": orig})
-
+    for info in infos:
+        info["cached_url"] = cached.get(info["sha256"])
     try:
         t0 = time.monotonic()
-        upload_results = await handle_uploads_sequential(infos, title, session_cookie)
+        gallery = None
+        if not all(info["cached_url"] for info in infos):
+            gallery, own_client = await asyncio.to_thread(
+                new_gallery, title, saved, session_cookie
+            )
+            await own_client.aclose()
+        upload_results, gallery_url, edit_url = await run_on_io_loop(
+            handle_uploads(infos, title, gallery, saved)
+        )
         upload_time = time.monotonic() - t0
+        if gallery_url:
+            flask_session["authCookie"] = session_cookie
+            await asyncio.to_thread(save_gallery_link, title, gallery_url, edit_url)
+            saved_links = {
+                **saved_links,
+                title: {"gallery_url": gallery_url, "edit_url": edit_url},
+            }
+            await asyncio.to_thread(
+                save_uploads, title,
+                [(i["sha256"], i["url"]) for i in infos if i.get("url")]
+            )
     except Exception as e:
         log.exception("Upload error")
-        upload_results = f"<b>Unexpected error:</b> {e}"
+        upload_results = f"<b>Unexpected error:</b> {html.escape(str(e))}"
         upload_time = None
     finally:
-        for info in infos:
-            try:
-                os.remove(info["path"])
-            except:
-                pass
+        await asyncio.to_thread(close_streams, infos)
 
-    return render_template_string(
-        INDEX_HTML,
-        error_message=None,
+    return _render(
+        saved_links,
         upload_results=upload_results,
         upload_time=upload_time,
-        session_cookie=session_cookie,
-        saved_links=load_saved_links()
+        session_cookie=session_cookie
     )
 
 
-async def handle_uploads_sequential(infos, title, session_cookie):
+async def upload_file(g, info):
+    """
+    Hands the spooled contents of one file straight to pyimgbox, skipping
+    Gallery.upload() which insists on re-opening a path on disk.
+
+    The bytes are read out rather than passing the stream itself: httpx
+    sizes file objects via fileno(), which would force a rollover to disk.
+    """
+    name = info["name"]
+    if info["size"] > pyimgbox.MAX_FILE_SIZE:
+        return pyimgbox.Submission(
+            filepath=name,
+            error=f"File is larger than {pyimgbox.MAX_FILE_SIZE} bytes"
+        )
+    stream = info["stream"]
+    stream.seek(0)
+    data = await asyncio.to_thread(stream.read)
+    return await g._upload_image(name, (name, data), None)
+
+
+async def _upload_one(info, g, sem):
     """
-    Creates or appends to an Imgbox gallery, then uploads each file
-    one-by-one in order, preserving sequence.
+    Uploads a single file under the shared semaphore. Transient HTTP
+    failures are retried by RetryTransport; anything raised here is
+    reported as that file's outcome. Returns the submission.
     """
-    saved   = load_saved_links().get(title, {})
-    edit_url= saved.get("edit_url")
+    async with sem:
+        try:
+            return await upload_file(g, info)
+        except Exception as exc:
+            log.warning(f"Upload failed for {info['name']}: {exc}")
+            return exc
 
+
+def new_gallery(title, saved, session_cookie):
+    """
+    Builds the pyimgbox Gallery for an upload, routed through the shared
+    pool. pyimgbox gives every Gallery its own AsyncClient (and SSL
+    context), which is slow to build, so this runs in a worker thread
+    rather than on the I/O loop. Returns (gallery, own_client); the
+    caller must aclose() own_client, which is never used.
+    """
     # Instantiate gallery properly
+    edit_url = saved.get("edit_url")
     if edit_url:
-        m = re.search(r"/upload/edit/([^/]+)/([^/]+)", edit_url)
+        m = _EDIT_URL_RE.search(edit_url)
         if m:
             slug, token = m.groups()
             gallery = pyimgbox.Gallery(id=slug, token=token)
@@ -234,61 +615,110 @@ async def handle_uploads_sequential(infos, title, session_cookie):
         gallery = pyimgbox.Gallery(title=title)
         log.info(f"Creating new gallery '{title}'")
 
-    # Inject your session cookie into the HTTPX client
-    httpx_client = gallery._client._client
-    httpx_client.headers["Cookie"] = f"_imgbox_session={session_cookie}"
-
-    results = []
-    async with gallery as g:
-        # Force creation & token fetch before any uploads
-        await g.create()
-
-        # Upload sequentially
-        for info in infos:
-            name = info["name"]
-            backoff = 1
-            submission = None
-
-            # Retry up to 5 times on transient errors
-            for attempt in range(5):
-                try:
-                    submission = await g.upload(info["path"])
-                    break
-                except Exception as exc:
-                    if attempt == 4:
-                        submission = exc
-                    else:
-                        log.warning(f"Retry {attempt+1} for {name}: {exc}")
-                        await asyncio.sleep(backoff)
-                        backoff *= 2
-
-            # Record the outcome
-            if isinstance(submission, Exception):
-                results.append(f"<b>Failed:</b> {name} – {submission}")
-            elif getattr(submission, "success", False):
-                url = submission.web_url or submission.image_url or ""
-                results.append(
-                    f"<b>OK:</b> {name} → <a href='{url}' target='_blank'>{url}</a>"
-                )
-            else:
-                err = getattr(submission, "error", "Unknown error")
-                results.append(f"<b>Fail:</b> {name} – {err}")
-
-    # Persist gallery & edit URLs
-    if gallery.url:
-        save_gallery_link(title, gallery.url, gallery.edit_url)
-        results.insert(
-            0,
-            f"<b>Gallery URL:</b> <a href='{gallery.url}' target='_blank'>{gallery.url}</a>"
+    own_client = gallery._client._client
+    # Route requests through the shared pool; the session cookie goes in
+    # pyimgbox's per-request headers rather than on the shared client.
+    # The gallery is deliberately not closed, as that would close the pool.
+    gallery._client._client = SHARED_CLIENT
+    gallery._client.headers["Cookie"] = f"_imgbox_session={session_cookie}"
+
+    return gallery, own_client
+
+
+async def handle_uploads(infos, title, gallery, saved):
+    """
+    Creates or appends to an Imgbox gallery, then uploads the files
+    concurrently (at most CONCURRENCY in flight), reporting results in
+    the original order. Files whose content is already in the gallery
+    (info["cached_url"]) are skipped; if that is all of them imgbox is
+    not contacted at all and gallery may be None. Returns (results_html,
+    gallery_url, edit_url), sets info["url"] for each new upload and
+    leaves persisting to the caller.
+    """
+    pending = [info for info in infos if not info["cached_url"]]
+    if not pending:
+        log.info(f"All files already in '{title}', nothing to upload.")
+        return (
+            _format_results(infos, {}, saved["gallery_url"], saved["edit_url"]),
+            saved["gallery_url"], saved["edit_url"]
+        )
+
+    # Force creation & token fetch before any uploads
+    await gallery.create()
+
+    # Upload concurrently; on the shared HTTP/2 connection opened by
+    # create() each POST is just another stream. gather() keeps order.
+    sem = asyncio.Semaphore(CONCURRENCY)
+    submissions = await asyncio.gather(
+        *(_upload_one(info, gallery, sem) for info in pending)
+    )
+    outcomes = {id(info): sub for info, sub in zip(pending, submissions)}
+    for info, submission in zip(pending, submissions):
+        if getattr(submission, "success", False):
+            info["url"] = submission.web_url or submission.image_url
+
+    return (
+        _format_results(infos, outcomes, gallery.url, gallery.edit_url),
+        gallery.url, gallery.edit_url
+    )
+
+
+def _format_results(infos, outcomes, gallery_url, edit_url):
+    """
+    Renders one line per file in upload order, headed by the gallery
+    links. Everything user- or server-supplied is escaped since the
+    block is rendered |safe.
+    """
+    results = deque()
+    for info in infos:
+        name = html.escape(info["name"])
+        submission = outcomes.get(id(info))
+        if info["cached_url"]:
+            url = html.escape(info["cached_url"])
+            results.append(
+                f"<b>Already uploaded:</b> {name} → <a href='{url}' target='_blank'>{url}</a>"
+            )
+        elif isinstance(submission, Exception):
+            results.append(f"<b>Failed:</b> {name} – {html.escape(str(submission))}")
+        elif getattr(submission, "success", False):
+            url = html.escape(info["url"] or "")
+            results.append(
+                f"<b>OK:</b> {name} → <a href='{url}' target='_blank'>{url}</a>"
+            )
+        else:
+            err = html.escape(str(getattr(submission, "error", "Unknown error")))
+            results.append(f"<b>Fail:</b> {name} – {err}")
+
+    if gallery_url:
+        edit = html.escape(edit_url)
+        url  = html.escape(gallery_url)
+        results.appendleft(
+            f"<b>Edit URL:</b> <a href='{edit}' target='_blank'>{edit}</a>"
         )
-        results.insert(
-            1,
-            f"<b>Edit URL:</b> <a href='{gallery.edit_url}' target='_blank'>{gallery.edit_url}</a>"
+        results.appendleft(
+            f"<b>Gallery URL:</b> <a href='{url}' target='_blank'>{url}</a>"
         )
 
     return "<br>".join(results)
 
 
+# ASGI entry point for a production server, e.g.
+#   hypercorn --workers 4 --worker-class uvloop --bind 127.0.0.1:5000 PythonApplication1:asgi
+# Each request runs on one of THREADS pool threads with its body streamed
+# in, so a long upload neither blocks other requests nor gets buffered
+# whole before Flask sees it.
+asgi = WSGIMiddleware(app, workers=THREADS)
+
+
 if __name__ == "__main__":
-    log.info("Starting Flask server at http://127.0.0.1:5000")
-    app.run(debug=True, host="127.0.0.1", port=5000)
+    if os.environ.get("DEV"):
+        log.info("Starting Flask dev server at http://127.0.0.1:5000")
+        app.run(debug=True, host="127.0.0.1", port=5000)
+    else:
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+
+        config = Config()
+        config.bind = ["127.0.0.1:5000"]
+        log.info("Starting Hypercorn at http://127.0.0.1:5000")
+        asyncio.run(serve(asgi, config))